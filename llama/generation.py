@@ -13,7 +13,7 @@ from typing import List, Literal, Optional, Tuple, TypedDict
 import torch
 import torch.nn.functional as F
 
-from llama.model import ModelArgs, Transformer
+from llama.model import Attention, ModelArgs, Transformer, fuse_checkpoint, quantize_checkpoint
 from llama.tokenizer import Tokenizer
 from llama.xla_model_parallel import get_model_parallel_rank, get_model_parallel_world_size, set_g_group
 
@@ -58,16 +58,24 @@ You are a helpful, respectful and honest assistant. Always answer as helpfully a
 
 If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information."""
 
+# Prompts are processed in sections of one of these lengths.
+PROMPT_BUCKETS = [128, 256, 384, 512]
+
 ## sharding configuration for TPU v3-8
+# Size of mesh axis 'y', which shards the output rows of the column parallel
+# weights. The fused wqkv/w13 weights are laid out in this many blocks so each
+# shard holds its own q/k/v (w1/w3) rows.
+MESH_Y = 2
 LLAMA2_RULES = [
+    ("weight_scaler", (2,)),
     ("tok_embeddings", (2, 3)),
-    ("attention\\.(wq|wk|wv)", (2, 3)),
+    ("attention\\.wqkv", (2, 3)),
     ("attention\\.wo", (2, 3)),
-    ("attention\\.cache_k", (0, 1, 2, 3)),
-    ("attention\\.cache_v", (0, 1, 2, 3)),
-    ("feed_forward\\.w1", (2, 3)),
+    ("attention\\.cache_(k|v)_scale", (0, 2, 1)),
+    ("attention\\.cache_k", (0, 2, 1, 3)),
+    ("attention\\.cache_v", (0, 2, 1, 3)),
+    ("feed_forward\\.w13", (2, 3)),
     ("feed_forward\\.w2", (2, 3)),
-    ("feed_forward\\.w3", (2, 3)),
     ("output", (2, 3))
 ]
 
@@ -94,13 +102,15 @@ class Llama:
             sys.stdout = open(os.devnull, "w")
 
         start_time = time.time()
+        fused_blocks = 1 if USE_CUDA else MESH_Y
         checkpoints = sorted(Path(ckpt_dir).glob("*.pth"))
         if len(checkpoints) > 0:
             assert model_parallel_size == len(
                 checkpoints
             ), f"Loading a checkpoint for MP={len(checkpoints)} but world size is {model_parallel_size}"
             ckpt_path = checkpoints[rank]
-            checkpoint = torch.load(ckpt_path, map_location="cpu")
+            checkpoint = fuse_checkpoint(torch.load(ckpt_path, map_location="cpu"),
+                                         fused_blocks)
         else:
             print(f"no checkpoint files found in {ckpt_dir}, init model without loading checkpoint.")
             checkpoint = None
@@ -110,6 +120,7 @@ class Llama:
         model_args: ModelArgs = ModelArgs(
             max_seq_len=max_seq_len,
             max_batch_size=max_batch_size,
+            fused_blocks=fused_blocks,
             **params,
         )
         tokenizer = Tokenizer(model_path=tokenizer_path)
@@ -119,6 +130,8 @@ class Llama:
         else:
             torch.set_default_tensor_type(torch.BFloat16Tensor)
         model = Transformer(model_args)
+        if checkpoint and model_args.quant:
+            checkpoint = quantize_checkpoint(checkpoint, model)
         if checkpoint:
             model.load_state_dict(checkpoint, strict=False)
         model = model.to(device)
@@ -130,21 +143,76 @@ class Llama:
         self.model = model
         self.tokenizer = tokenizer
         self.device = device
+        self.dynamo = dynamo
         self.partition_mesh()
 
+        # kv_len is a static shape of every compiled graph, so it only takes
+        # kv_page_size * 2**k values (capped at max_seq_len). That keeps the
+        # number of graphs logarithmic in max_seq_len, and decoding only
+        # recompiles when the context doubles.
+        params = self.model.params
+        self._kv_lens = [min(params.kv_page_size, params.max_seq_len)]
+        while self._kv_lens[-1] < params.max_seq_len:
+            self._kv_lens.append(min(2 * self._kv_lens[-1], params.max_seq_len))
+
         self._generate_one_token_fn = self._generate_one_token
+        self._prefill_fn = self.model.prefill
+        self._decode_fn = self.model.decode
         if dynamo:
+            # Every kv_len gets its own cache entry per generation mode (greedy,
+            # sampling, logprobs) and, for prefill, per prompt bucket; on TPU
+            # prefill and decode share one code object. Raise dynamo's
+            # recompile limit (8 by default) to cover all of them, instead of
+            # failing or falling back to eager in the middle of a generation.
+            cache_entries = 4 * (len(PROMPT_BUCKETS) + 1) * len(self._kv_lens)
+            torch._dynamo.config.cache_size_limit = max(
+                torch._dynamo.config.cache_size_limit, cache_entries)
+            if hasattr(torch._dynamo.config, "accumulated_cache_size_limit"):
+                # Newer dynamo also caps the entries across all code objects.
+                torch._dynamo.config.accumulated_cache_size_limit = max(
+                    torch._dynamo.config.accumulated_cache_size_limit, 2 * cache_entries)
             if USE_CUDA:
-                self.model = torch.compile(self.model, fullgraph=True)
+                # The KV caches are updated in place and never rebound, so let
+                # the compiled graph treat them as fixed addresses instead of
+                # guarding on them.
+                for module in self.model.modules():
+                    if isinstance(module, Attention):
+                        torch._dynamo.mark_static_address(module.cache_k)
+                        torch._dynamo.mark_static_address(module.cache_v)
+                        if module.kv_cache_quant:
+                            torch._dynamo.mark_static_address(module.cache_k_scale)
+                            torch._dynamo.mark_static_address(module.cache_v_scale)
+                if get_model_parallel_world_size() > 1:
+                    # Let inductor schedule independent compute between the
+                    # start and the wait of the tensor parallel all-reduces.
+                    import torch._inductor.config
+                    torch._inductor.config.reorder_for_compute_comm_overlap = True
+                # Prompt sections and single-token decode steps get separately
+                # compiled graphs. The decode graph has fixed shapes and runs
+                # under CUDA graphs to remove per-token launch overhead.
+                self._prefill_fn = torch.compile(self.model.prefill, fullgraph=True)
+                self._decode_fn = torch.compile(self.model.decode,
+                                                mode="reduce-overhead",
+                                                fullgraph=True,
+                                                dynamic=False)
             else:
+                # XLA needs static shapes: specialize on kv_len rather than
+                # letting dynamo turn it into a symbolic int.
                 self._generate_one_token_fn = torch.compile(
                     self._generate_one_token_fn,
                     backend="openxla_eval",
-                    fullgraph=True)
+                    fullgraph=True,
+                    dynamic=False)
+        elif USE_CUDA:
+            # Without dynamo, replay decode steps from captured CUDA graphs to
+            # avoid launching every kernel of the model from Python per token.
+            self._decode_graphs = {}
+            self._decode_graph_pool = None
+            self._decode_fn = self._cuda_graph_decode
     
     def partition_mesh(self):
         num_devices = xr.global_runtime_device_count()
-        mesh_shape = (1, 1, 2, num_devices // 2)   ## mesh shape for TPU v3-8
+        mesh_shape = (1, 1, MESH_Y, num_devices // MESH_Y)   ## mesh shape for TPU v3-8
         device_ids = np.array(range(num_devices))
         mesh = Mesh(device_ids, mesh_shape, ('w', 'x', 'y', 'z'))
         device=xm.xla_device()
@@ -160,20 +228,66 @@ class Llama:
                     break
         print('Sharding done.')
 
+    def _cuda_graph_decode(self, tokens, input_indexes, output_index, kv_len, greedy=False):
+        """Run Transformer.decode by replaying a captured CUDA graph.
+
+        One graph is captured per (kv_len, output_index is None, greedy) and
+        shares a memory pool with the others. Inputs are copied into the
+        graph's static tensors before each replay; the KV caches are updated
+        in place, so they are already at fixed addresses. The returned output
+        is overwritten by the next replay.
+        """
+        key = (kv_len, output_index is None, greedy)
+        if key not in self._decode_graphs:
+            static_inputs = (tokens.clone(), input_indexes.clone(),
+                             None if output_index is None else output_index.clone())
+            # Warm up on a side stream before capturing. Decoding the same
+            # token at the same position again rewrites identical cache rows.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self.model.decode(*static_inputs, kv_len, greedy)
+            torch.cuda.current_stream().wait_stream(stream)
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=self._decode_graph_pool):
+                static_output = self.model.decode(*static_inputs, kv_len, greedy)
+            self._decode_graph_pool = graph.pool()
+            self._decode_graphs[key] = (graph, static_inputs, static_output)
+
+        graph, static_inputs, static_output = self._decode_graphs[key]
+        for static_input, value in zip(static_inputs, (tokens, input_indexes, output_index)):
+            if static_input is not None:
+                static_input.copy_(value)
+        graph.replay()
+        return static_output
+
+    def _kv_len(self, num_positions: int) -> int:
+        """Number of KV cache positions to attend over when the first
+        num_positions positions may be live: the smallest of self._kv_lens
+        that covers them.
+        """
+        return next(kv_len for kv_len in self._kv_lens if kv_len >= num_positions)
+
     def _generate_one_token(self, tokens, input_tokens, input_text_mask,
                             cur_pos_tensor, input_pos_tensor,
                             output_pos_tensor, temperature_tensor,
-                            top_p_tensor, with_temp, logprobs, token_logprobs, eos_reached, pad_id):
+                            top_p_tensor, with_temp, logprobs, token_logprobs, eos_reached, pad_id,
+                            decode, kv_len):
+        model_fn = self._decode_fn if decode else self._prefill_fn
         if logprobs:
-            full_logits = self.model(input_tokens, input_pos_tensor, None)
+            full_logits = model_fn(input_tokens, input_pos_tensor, None, kv_len)
             logits = full_logits.index_select(1, output_pos_tensor - input_pos_tensor[0]).squeeze(dim=1)
-        else:
-            logits = self.model(input_tokens, input_pos_tensor, output_pos_tensor)
+        elif with_temp:
+            logits = model_fn(input_tokens, input_pos_tensor, output_pos_tensor, kv_len)
         if with_temp:
             probs = torch.softmax(logits / temperature_tensor, dim=-1)
             next_token = sample_top_p(probs, top_p_tensor)
-        else:
+        elif logprobs:
             next_token = torch.argmax(logits, dim=-1)
+        else:
+            # Greedy decoding without logprobs never needs the logits.
+            next_token = model_fn(input_tokens, input_pos_tensor, output_pos_tensor, kv_len,
+                                  greedy=True)
 
         next_token = next_token.reshape(-1)
         # only replace token if prompt has already been generated
@@ -244,16 +358,15 @@ class Llama:
 
         decoding_start_time = time.time()
         prev_pos = 0
-        buckets = [128, 256, 384, 512]
         while prev_pos < min_prompt_len:
             remaining = min_prompt_len - prev_pos
             section_len = 0
-            for bucket in buckets:
+            for bucket in PROMPT_BUCKETS:
                 if bucket >= remaining:
                     section_len = bucket
                     break
             if section_len == 0:
-                section_len = buckets[-1]
+                section_len = PROMPT_BUCKETS[-1]
 
             assert prev_pos + section_len <= params.max_seq_len
             cur_pos = min(min_prompt_len, prev_pos + section_len)
@@ -262,6 +375,12 @@ class Llama:
             input_pos_tensor = torch.arange(prev_pos, prev_pos + section_len).to(self.device)
             output_pos_tensor = cur_pos_tensor - 1
             input_tokens = tokens.index_select(1, input_pos_tensor)
+            if USE_CUDA and self.dynamo:
+                # Prompt sections come in several bucket lengths; compile a
+                # single graph that is dynamic in the section length rather
+                # than recompiling for every bucket.
+                torch._dynamo.mark_dynamic(input_tokens, 1)
+                torch._dynamo.mark_dynamic(input_pos_tensor, 0)
             if self.device.type == "xla":
                 xm.mark_step()
 
@@ -270,7 +389,8 @@ class Llama:
                     tokens, input_tokens, input_text_mask,
                     cur_pos_tensor, input_pos_tensor,
                     output_pos_tensor, temperature_tensor,
-                    top_p_tensor, with_temp, logprobs, token_logprobs, eos_reached, pad_id
+                    top_p_tensor, with_temp, logprobs, token_logprobs, eos_reached, pad_id,
+                    decode=False, kv_len=self._kv_len(prev_pos + section_len)
                 )
             if self.device.type == "xla":
                 xm.mark_step()
@@ -284,7 +404,8 @@ class Llama:
                     tokens, input_tokens, input_text_mask,
                     cur_pos_tensor, input_pos_tensor,
                     output_pos_tensor, temperature_tensor,
-                    top_p_tensor, with_temp, logprobs, token_logprobs, eos_reached, pad_id
+                    top_p_tensor, with_temp, logprobs, token_logprobs, eos_reached, pad_id,
+                    decode=True, kv_len=self._kv_len(cur_pos)
                 )
             if self.device.type == "xla":
                 xm.mark_step()
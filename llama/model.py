@@ -1,15 +1,15 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-import math
 from dataclasses import dataclass
-from typing import Any, Optional, Tuple, List
+from typing import Any, Dict, Optional, Tuple, List
 
 import torch
 import torch.nn.functional as F
 from fairscale.nn.model_parallel.utils import divide_and_check_no_remainder
 
 from .xla_model_parallel import (
+    USE_CUDA,
     ParallelEmbedding,
     RowParallelLinear,
     ColumnParallelLinear,
@@ -19,6 +19,9 @@ from .xla_model_parallel import (
 )
 from torch import nn
 
+# F.rms_norm is available from PyTorch 2.4.
+_HAS_RMS_NORM = hasattr(F, "rms_norm")
+
 
 @dataclass
 class ModelArgs:
@@ -31,9 +34,23 @@ class ModelArgs:
     ffn_dim_multiplier: Optional[float] = None
     norm_eps: float = 1e-5
 
+    # The fused wqkv/w13 output rows are stored as this many consecutive
+    # blocks, each holding its share of every fused projection, so sharding
+    # those rows into fused_blocks pieces keeps every shard self-contained.
+    fused_blocks: int = 1
+
     max_batch_size: int = 32
     max_seq_len: int = 2048
+    # Attention reads the KV cache up to the smallest kv_page_size * 2**k
+    # positions (capped at max_seq_len) that hold every live token, instead of
+    # all max_seq_len positions.
+    kv_page_size: int = 128
     quant: bool = False
+    # Store the KV cache as int8 with one scale per (batch, head, position).
+    # On TPU the dequantize fuses into attention, so the cache is also read as
+    # int8. On CUDA the live part is dequantized to a bf16/fp16 copy before
+    # SDPA, so this saves cache memory capacity, not memory bandwidth.
+    kv_cache_quant: bool = False
     gpu: bool = False
 
 
@@ -44,59 +61,64 @@ class RMSNorm(torch.nn.Module):
         self.weight = nn.Parameter(torch.ones(dim))
 
     def _norm(self, x):
-        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
+        # Square and average in FP32, since squares of large fp16 residuals
+        # overflow; only the final scaling runs in x's dtype.
+        rms = torch.rsqrt(x.float().pow(2).mean(-1, keepdim=True) + self.eps)
+        return x * rms.type_as(x)
 
     def forward(self, x):
-        output = self._norm(x.float()).type_as(x)
-        return output * self.weight
+        if _HAS_RMS_NORM:
+            # F.rms_norm only upcasts internally on newer releases (in 2.4/2.5
+            # it squares in x's dtype), so give it an FP32 input; as in _norm,
+            # only the scaling by weight runs in x's dtype.
+            return F.rms_norm(x.float(), (x.shape[-1],), None, self.eps).type_as(x) * self.weight
+        return self._norm(x) * self.weight
 
 
-def precompute_freqs_cis(dim: int, end: int, theta: float = 10000.0):
+def precompute_freqs_cos_sin(dim: int, end: int, theta: float = 10000.0,
+                             dtype: Optional[torch.dtype] = None) -> Tuple[torch.Tensor, torch.Tensor]:
     freqs = 1.0 / (theta ** (torch.arange(0, dim, 2)[: (dim // 2)].float() / dim))
-    t = torch.arange(end, device=freqs.device)  # type: ignore
-    freqs = torch.outer(t, freqs).float()  # type: ignore
-    freqs_cis = torch.polar(torch.ones_like(freqs), freqs)  # complex64
-    return freqs_cis
-
-
-def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
-    ndim = x.ndim
-    assert 0 <= 1 < ndim
-    assert freqs_cis.shape == (x.shape[1], x.shape[-1])
-    shape = [d if i == 1 or i == ndim - 1 else 1 for i, d in enumerate(x.shape)]
-    return freqs_cis.view(*shape)
+    t = torch.arange(end, device=freqs.device).float()  # type: ignore
+    freqs = torch.outer(t, freqs)  # type: ignore
+    # The angles are computed in FP32; only the (end, dim // 2) tables are cast.
+    return torch.cos(freqs).to(dtype), torch.sin(freqs).to(dtype)
 
 
 def apply_rotary_emb(
     xq: torch.Tensor,
     xk: torch.Tensor,
-    freqs_cis: torch.Tensor,
+    freqs_cos: torch.Tensor,
+    freqs_sin: torch.Tensor,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
-    xq_ = torch.view_as_complex(
-        xq.transpose(1, 2).reshape(-1, xq.shape[1], int(xq.shape[-1] / 2),
-                                   2).float())
-    xk_ = torch.view_as_complex(
-        xk.transpose(1, 2).reshape(-1, xq.shape[1], int(xq.shape[-1] / 2),
-                                   2).float())
-    xq_out = torch.view_as_real(xq_ * freqs_cis)
-    xk_out = torch.view_as_real(xk_ * freqs_cis)
-    xq_out = xq_out.reshape(xq.shape[0], xq.shape[2], xq.shape[1],
-                            xq.shape[3]).transpose(1, 2)
-    xk_out = xk_out.reshape(xk.shape[0], xk.shape[2], xk.shape[1],
-                            xk.shape[3]).transpose(1, 2)
+    # Rotate the interleaved (even, odd) pairs of the head dim with real
+    # arithmetic instead of a complex64 multiply, so no transposes or complex
+    # temporaries are needed.
+    xq_ = xq.reshape(*xq.shape[:-1], -1, 2)
+    xk_ = xk.reshape(*xk.shape[:-1], -1, 2)
+    xq_r, xq_i = xq_.unbind(-1)
+    xk_r, xk_i = xk_.unbind(-1)
+    # (seqlen, head_dim // 2) -> (seqlen, 1, head_dim // 2), broadcasting over
+    # the batch and head dims.
+    freqs_cos = freqs_cos.unsqueeze(1)
+    freqs_sin = freqs_sin.unsqueeze(1)
+    xq_out = torch.stack(
+        [xq_r * freqs_cos - xq_i * freqs_sin, xq_r * freqs_sin + xq_i * freqs_cos], dim=-1
+    ).flatten(3)
+    xk_out = torch.stack(
+        [xk_r * freqs_cos - xk_i * freqs_sin, xk_r * freqs_sin + xk_i * freqs_cos], dim=-1
+    ).flatten(3)
     return xq_out.type_as(xq), xk_out.type_as(xk)
 
 
-def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
-    """torch.repeat_interleave(x, dim=2, repeats=n_rep)"""
-    bs, slen, n_kv_heads, head_dim = x.shape
-    if n_rep == 1:
-        return x
-    return (
-        x[:, :, :, None, :]
-        .expand(bs, slen, n_kv_heads, n_rep, head_dim)
-        .reshape(bs, slen, n_kv_heads * n_rep, head_dim)
-    )
+def quantize_kv(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric int8 quantization of (..., head_dim) keys or values with one
+    scale per vector. Returns the int8 values and the (...) scales in x's dtype."""
+    x_float = x.float()
+    # Round the scales to the dtype they are stored in, then quantize in FP32
+    # against them, so the int8 values are exact for the stored scales.
+    scale = (x_float.abs().amax(dim=-1).clamp(min=1e-6) / 127.0).to(x.dtype)
+    x_int8 = torch.round(x_float / scale.float()[..., None]).clamp(-127, 127).to(torch.int8)
+    return x_int8, scale
 
 
 class Attention(nn.Module):
@@ -117,36 +139,17 @@ class Attention(nn.Module):
         self.n_local_kv_heads = divide_and_check_no_remainder(self.n_kv_heads, model_parallel_size)
         self.n_rep = self.n_local_heads // self.n_local_kv_heads
         self.head_dim = args.dim // args.n_heads
+        self.fused_blocks = args.fused_blocks
+        divide_and_check_no_remainder(self.n_local_kv_heads, self.fused_blocks)
 
         init_method = lambda x: x
 
-        self.wq = ColumnParallelLinear(
-            args.dim,
-            args.n_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=init_method,
-            world_size=world_size,
-            rank=rank,
-            groups=groups,
-            quant=args.quant,
-            gpu=args.gpu,
-        )
-        self.wk = ColumnParallelLinear(
+        # wq, wk and wv are fused into a single projection so x is read once;
+        # the output is split back into q/k/v in forward(). Its rows are laid
+        # out as args.fused_blocks blocks of [q_i; k_i; v_i] heads.
+        self.wqkv = ColumnParallelLinear(
             args.dim,
-            self.n_kv_heads * self.head_dim,
-            bias=False,
-            gather_output=False,
-            init_method=init_method,
-            world_size=world_size,
-            rank=rank,
-            groups=groups,
-            quant=args.quant,
-            gpu=args.gpu,
-        )
-        self.wv = ColumnParallelLinear(
-            args.dim,
-            self.n_kv_heads * self.head_dim,
+            (args.n_heads + 2 * self.n_kv_heads) * self.head_dim,
             bias=False,
             gather_output=False,
             init_method=init_method,
@@ -169,59 +172,94 @@ class Attention(nn.Module):
             gpu=args.gpu,
         )
 
+        self.kv_cache_quant = args.kv_cache_quant
+        cache_dtype = torch.int8 if self.kv_cache_quant else None
         cache_k = torch.zeros(
             (
                 args.max_batch_size,
-                args.max_seq_len,
                 self.n_local_kv_heads,
+                args.max_seq_len,
                 self.head_dim,
-            )
+            ),
+            dtype=cache_dtype,
         )
         self.register_buffer("cache_k", cache_k)
         cache_v = torch.zeros(
             (
                 args.max_batch_size,
-                args.max_seq_len,
                 self.n_local_kv_heads,
+                args.max_seq_len,
                 self.head_dim,
-            )
+            ),
+            dtype=cache_dtype,
         )
         self.register_buffer("cache_v", cache_v)
+        if self.kv_cache_quant:
+            scale_shape = (args.max_batch_size, self.n_local_kv_heads, args.max_seq_len)
+            self.register_buffer("cache_k_scale", torch.zeros(scale_shape))
+            self.register_buffer("cache_v_scale", torch.zeros(scale_shape))
 
     def forward(
         self,
         x: torch.Tensor,
-        freqs_cis: torch.Tensor,
+        freqs_cos: torch.Tensor,
+        freqs_sin: torch.Tensor,
         mask: Optional[torch.Tensor],
         input_indexes: torch.Tensor,
+        kv_len: int,
     ):
         bsz, seqlen, _ = x.shape
-        xq, xk, xv = self.wq(x), self.wk(x), self.wv(x)
-
-        xq = xq.view(bsz, seqlen, self.n_local_heads, self.head_dim)
-        xk = xk.view(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
-        xv = xv.view(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
-
-        xq, xk = apply_rotary_emb(xq, xk, freqs_cis=freqs_cis)
-
-        self.cache_k = self.cache_k.index_copy(1, input_indexes, xk)
-        self.cache_v = self.cache_v.index_copy(1, input_indexes, xv)
-
-        keys = self.cache_k[:, :]
-        values = self.cache_v[:, :]
-
-        # repeat k/v heads if n_kv_heads < n_heads
-        keys = repeat_kv(keys, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
-        values = repeat_kv(values, self.n_rep)  # (bs, seqlen, n_local_heads, head_dim)
+        xq, xk, xv = self.wqkv(x).view(bsz, seqlen, self.fused_blocks, -1).split(
+            [
+                self.n_local_heads // self.fused_blocks * self.head_dim,
+                self.n_local_kv_heads // self.fused_blocks * self.head_dim,
+                self.n_local_kv_heads // self.fused_blocks * self.head_dim,
+            ],
+            dim=-1,
+        )
 
-        xq = xq.transpose(1, 2)  # (bs, n_local_heads, seqlen, head_dim)
-        keys = keys.transpose(1, 2)
-        values = values.transpose(1, 2)
-        scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
-        scores = scores + mask  # (bs, n_local_heads, seqlen, max_seqlen)
-        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-        output = torch.matmul(scores, values)  # (bs, n_local_heads, seqlen, head_dim)
-        output = output.transpose(1, 2).contiguous().view(bsz, seqlen, -1)
+        xq = xq.reshape(bsz, seqlen, self.n_local_heads, self.head_dim)
+        xk = xk.reshape(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
+        xv = xv.reshape(bsz, seqlen, self.n_local_kv_heads, self.head_dim)
+
+        xq, xk = apply_rotary_emb(xq, xk, freqs_cos=freqs_cos, freqs_sin=freqs_sin)
+
+        # Fold the n_rep query heads that share a kv head into the query
+        # sequence dim, so the cache is attended with n_local_kv_heads heads
+        # and never expanded. Row s * n_rep + r of a kv head is query head r
+        # at position s; the mask rows are laid out to match.
+        xq = xq.view(bsz, seqlen, self.n_local_kv_heads, self.n_rep, self.head_dim)
+        xq = xq.transpose(1, 2).reshape(
+            bsz, self.n_local_kv_heads, seqlen * self.n_rep, self.head_dim)
+        xk = xk.transpose(1, 2)  # (bs, n_local_kv_heads, seqlen, head_dim)
+        xv = xv.transpose(1, 2)
+
+        if self.kv_cache_quant:
+            xk, xk_scale = quantize_kv(xk)
+            xv, xv_scale = quantize_kv(xv)
+            self.cache_k_scale.index_copy_(2, input_indexes, xk_scale)
+            self.cache_v_scale.index_copy_(2, input_indexes, xv_scale)
+
+        # Update the caches in place so only the new positions are written,
+        # instead of rebinding the buffers to fresh full-size copies.
+        self.cache_k.index_copy_(2, input_indexes, xk)
+        self.cache_v.index_copy_(2, input_indexes, xv)
+
+        # Only the first kv_len positions can hold live tokens.
+        keys = self.cache_k[:, :, :kv_len]  # (bs, n_local_kv_heads, kv_len, head_dim)
+        values = self.cache_v[:, :, :kv_len]
+        if self.kv_cache_quant:
+            # Dequantize the live part of the cache for attention. XLA fuses
+            # this into the attention matmuls, so the cache is read as int8;
+            # elsewhere it materializes a full precision copy (see
+            # ModelArgs.kv_cache_quant).
+            keys = keys.to(xq.dtype) * self.cache_k_scale[:, :, :kv_len, None]
+            values = values.to(xq.dtype) * self.cache_v_scale[:, :, :kv_len, None]
+
+        output = F.scaled_dot_product_attention(
+            xq, keys, values, attn_mask=mask)  # (bs, n_local_kv_heads, seqlen * n_rep, head_dim)
+        output = output.view(bsz, self.n_local_kv_heads, seqlen, self.n_rep, self.head_dim)
+        output = output.transpose(1, 2).reshape(bsz, seqlen, -1)
         return self.wo(output)
 
 
@@ -237,6 +275,7 @@ class FeedForward(nn.Module):
         groups: Optional[List] = None,
         quant: bool = False,
         gpu: bool = False,
+        fused_blocks: int = 1,
     ):
         super().__init__()
         hidden_dim = int(2 * hidden_dim / 3)
@@ -252,9 +291,13 @@ class FeedForward(nn.Module):
 
         init_method = lambda x: x
 
-        self.w1 = ColumnParallelLinear(
+        # w1 and w3 are fused into a single projection; forward() splits
+        # the output into the gate and up halves. Its rows are laid out as
+        # fused_blocks blocks of [w1_i; w3_i].
+        self.fused_blocks = fused_blocks
+        self.w13 = ColumnParallelLinear(
             dim,
-            hidden_dim,
+            2 * hidden_dim,
             bias=False,
             gather_output=False,
             init_method=init_method,
@@ -276,21 +319,12 @@ class FeedForward(nn.Module):
             quant=quant,
             gpu=gpu,
         )
-        self.w3 = ColumnParallelLinear(
-            dim,
-            hidden_dim,
-            bias=False,
-            gather_output=False,
-            init_method=init_method,
-            world_size=world_size,
-            rank=rank,
-            groups=groups,
-            quant=quant,
-            gpu=gpu,
-        )
 
     def forward(self, x):
-        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+        x13 = self.w13(x)
+        x1, x3 = x13.view(*x13.shape[:-1], self.fused_blocks, 2, -1).unbind(-2)
+        x1, x3 = x1.flatten(-2), x3.flatten(-2)
+        return self.w2(F.silu(x1) * x3)
 
 
 class TransformerBlock(nn.Module):
@@ -326,6 +360,7 @@ class TransformerBlock(nn.Module):
             groups=groups,
             quant=args.quant,
             gpu=args.gpu,
+            fused_blocks=args.fused_blocks,
         )
         self.layer_id = layer_id
         self.attention_norm = RMSNorm(args.dim, eps=args.norm_eps)
@@ -334,12 +369,14 @@ class TransformerBlock(nn.Module):
     def forward(
         self,
         x: torch.Tensor,
-        freqs_cis: torch.Tensor,
+        freqs_cos: torch.Tensor,
+        freqs_sin: torch.Tensor,
         mask: Optional[torch.Tensor],
         input_indexes: torch.Tensor,
+        kv_len: int,
     ):
         h = x + self.attention.forward(
-            self.attention_norm(x), freqs_cis, mask, input_indexes
+            self.attention_norm(x), freqs_cos, freqs_sin, mask, input_indexes, kv_len
         )
         out = h + self.feed_forward.forward(self.ffn_norm(h))
         return out
@@ -355,6 +392,8 @@ class Transformer(nn.Module):
         self.params = params
         self.vocab_size = params.vocab_size
         self.n_layers = params.n_layers
+        n_kv_heads = params.n_heads if params.n_kv_heads is None else params.n_kv_heads
+        self.n_rep = params.n_heads // n_kv_heads
 
         if world_size is None:
             groups = get_model_parallel_group()
@@ -395,30 +434,165 @@ class Transformer(nn.Module):
             gpu=params.gpu,
         )
 
-        freqs_cis = precompute_freqs_cis(
-            self.params.dim // self.params.n_heads, self.params.max_seq_len * 2
+        # Stored in the activation dtype so RoPE runs without upcasting q/k.
+        # cos and sin share one (end, head_dim) table so that a single row
+        # gather per step fetches both.
+        freqs_cos, freqs_sin = precompute_freqs_cos_sin(
+            self.params.dim // self.params.n_heads, self.params.max_seq_len * 2,
+            dtype=torch.get_default_dtype()
         )
-        self.register_buffer("freqs_cis", freqs_cis)
-
-        mask = torch.full(
-            (1, 1, self.params.max_seq_len, self.params.max_seq_len),
-            float("-inf")).to(torch.float)
-        mask = torch.triu(mask, diagonal=1)
-        self.register_buffer("mask", mask)
+        self.register_buffer("freqs_cos_sin", torch.cat([freqs_cos, freqs_sin], dim=-1))
 
-    @torch.no_grad()
-    def forward(self, tokens: torch.Tensor, input_indexes: torch.Tensor, output_index: Optional[torch.Tensor]):
+    def _forward_layers(self, tokens: torch.Tensor, input_indexes: torch.Tensor,
+                        kv_len: Optional[int]):
         _bsz, seqlen = tokens.shape
         assert _bsz == self.params.max_batch_size
+        if kv_len is None:
+            kv_len = self.params.max_seq_len
         h = self.tok_embeddings(tokens)
-        freqs_cis = self.freqs_cis.index_select(0, input_indexes)
+        freqs_cos, freqs_sin = self.freqs_cos_sin.index_select(0, input_indexes).chunk(2, dim=-1)
 
-        mask = self.mask.index_select(2, input_indexes)
+        # Causal mask rows for the (folded, see Attention) queries being
+        # processed, (seqlen * n_rep, kv_len). Built from a position
+        # comparison directly in the activation dtype rather than gathered
+        # from a (max_seqlen, max_seqlen) buffer.
+        query_positions = input_indexes[:, None].expand(-1, self.n_rep).reshape(-1)
+        key_positions = torch.arange(kv_len, device=tokens.device)
+        mask = torch.zeros((seqlen * self.n_rep, kv_len), dtype=h.dtype, device=h.device)
+        mask = mask.masked_fill(key_positions[None, :] > query_positions[:, None], float("-inf"))
 
         for layer in self.layers:
-            h = layer(h, freqs_cis, mask, input_indexes)
+            h = layer(h, freqs_cos, freqs_sin, mask, input_indexes, kv_len)
+        return h
+
+    def _output(self, h: torch.Tensor, greedy: bool):
         h = self.norm(h)
-        if output_index is not None:
-            h = h.index_select(1, output_index - input_indexes[0]).squeeze(dim=1)
+        if greedy and USE_CUDA and self.output.world_size == 1:
+            # Only the arg max is needed: reduce over vocab chunks instead of
+            # materializing the (bsz, vocab_size) logits. Not on XLA, where
+            # world_size is 1 but SPMD shards the output rows (LLAMA2_RULES),
+            # so chunk slices would cross shards.
+            return self.output.argmax(h)
         output = self.output(h).float()
+        if greedy:
+            return torch.argmax(output, dim=-1)
         return output
+
+    @torch.no_grad()
+    def prefill(self, tokens: torch.Tensor, input_indexes: torch.Tensor,
+                output_index: Optional[torch.Tensor] = None, kv_len: Optional[int] = None,
+                greedy: bool = False):
+        """Process a section of the prompt.
+
+        Returns the logits at output_index, or at every position of the
+        section if output_index is None. With greedy, returns the (bsz,)
+        arg max token at output_index instead, which then must be given.
+        kv_len bounds the cache positions attended over (all of max_seq_len
+        if None); it must cover every position up to input_indexes[-1].
+        """
+        assert output_index is not None or not greedy
+        h = self._forward_layers(tokens, input_indexes, kv_len)
+        if output_index is not None:
+            # Select the one position to sample from before the final norm
+            # and the vocab projection, so neither runs on the whole section.
+            h = h.index_select(1, output_index - input_indexes[0]).squeeze(dim=1)
+        return self._output(h, greedy)
+
+    @torch.no_grad()
+    def decode(self, tokens: torch.Tensor, input_indexes: torch.Tensor,
+               output_index: Optional[torch.Tensor] = None, kv_len: Optional[int] = None,
+               greedy: bool = False):
+        """Process a single new token per sequence (tokens is (bsz, 1)).
+
+        Returns (bsz, vocab_size) logits if output_index is given, otherwise
+        (bsz, 1, vocab_size) like prefill(). kv_len and greedy are as for
+        prefill().
+        """
+        assert output_index is not None or not greedy
+        h = self._forward_layers(tokens, input_indexes, kv_len)
+        if output_index is not None:
+            h = h.squeeze(dim=1)
+        return self._output(h, greedy)
+
+    @torch.no_grad()
+    def forward(self, tokens: torch.Tensor, input_indexes: torch.Tensor, output_index: Optional[torch.Tensor],
+                kv_len: Optional[int] = None):
+        if tokens.shape[1] == 1:
+            return self.decode(tokens, input_indexes, output_index, kv_len)
+        return self.prefill(tokens, input_indexes, output_index, kv_len)
+
+
+# Fused projection -> the per-projection checkpoint entries it replaces, in the
+# order their output features are concatenated.
+FUSED_LINEARS = {
+    "attention.wqkv": ("attention.wq", "attention.wk", "attention.wv"),
+    "feed_forward.w13": ("feed_forward.w1", "feed_forward.w3"),
+}
+
+
+def fuse_checkpoint(checkpoint: Dict[str, torch.Tensor],
+                    num_blocks: int = 1) -> Dict[str, torch.Tensor]:
+    """Convert a checkpoint with separate wq/wk/wv and w1/w3 weights to the fused
+    wqkv/w13 layout used by Attention and FeedForward.
+
+    Entries are concatenated along the output dimension, so this works on each
+    model parallel shard independently. With num_blocks > 1 (ModelArgs.fused_blocks)
+    every entry is split into num_blocks row blocks first and the fused weight
+    interleaves them, [wq_0; wk_0; wv_0; wq_1; ...]. Per-tensor quantization
+    scalers are expanded to per-output-channel so every fused row keeps the
+    scale of the projection it came from. Already fused checkpoints are
+    returned unchanged; they must have been fused with num_blocks=1.
+    """
+    checkpoint = dict(checkpoint)
+    if num_blocks > 1:
+        assert not any(key.endswith(f"{fused}.weight") for key in checkpoint
+                       for fused in FUSED_LINEARS), \
+            "already fused checkpoints have a single block per projection"
+    for key, value in list(checkpoint.items()):
+        if key.endswith(".weight_scaler") and value.numel() == 1:
+            rows = checkpoint[key[:-len("_scaler")]].shape[0]
+            checkpoint[key] = value.reshape(1).expand(rows).clone()
+
+    for key in list(checkpoint.keys()):
+        for fused, parts in FUSED_LINEARS.items():
+            if not key.endswith(f"{parts[0]}.weight"):
+                continue
+            prefix = key[:-len(f"{parts[0]}.weight")]
+            for suffix in ("weight", "weight_scaler"):
+                names = [f"{prefix}{part}.{suffix}" for part in parts]
+                if names[0] in checkpoint:
+                    tensors = [checkpoint.pop(name) for name in names]
+                    blocks = [
+                        tensor.split(divide_and_check_no_remainder(tensor.shape[0], num_blocks))
+                        for tensor in tensors
+                    ]
+                    checkpoint[f"{prefix}{fused}.{suffix}"] = torch.cat(
+                        [block[i] for i in range(num_blocks) for block in blocks], dim=0)
+    return checkpoint
+
+
+def quantize_checkpoint(checkpoint: Dict[str, torch.Tensor],
+                        model: nn.Module) -> Dict[str, torch.Tensor]:
+    """Quantize the float linear weights of a checkpoint for a model built with
+    ModelArgs.quant.
+
+    Every ColumnParallelLinear/RowParallelLinear weight is converted to int8 with
+    a symmetric absmax scale per output channel, stored as its weight_scaler.
+    Weights that already come with a weight_scaler are left unchanged.
+    """
+    checkpoint = dict(checkpoint)
+    for name, module in model.named_modules():
+        if not isinstance(module, (ColumnParallelLinear, RowParallelLinear)) or not module.quant:
+            continue
+        weight_key, scaler_key = f"{name}.weight", f"{name}.weight_scaler"
+        if weight_key not in checkpoint or scaler_key in checkpoint:
+            continue
+        weight = checkpoint[weight_key].float()
+        scaler = weight.abs().amax(dim=1).clamp(min=1e-12) / 127.0
+        # Round the scales to the dtype they are stored in before quantizing,
+        # so the int8 values are exact for the scales used at runtime.
+        scaler = scaler.to(module.weight_scaler.dtype)
+        weight = torch.round(weight / scaler.float()[:, None]).clamp(-127, 127)
+        checkpoint[weight_key] = weight.to(torch.int8)
+        checkpoint[scaler_key] = scaler
+    return checkpoint
@@ -141,8 +141,10 @@ def my_reduce(input_: torch.Tensor, groups, world_size, rank) -> torch.Tensor:
 
     # All-reduce.
     if USE_CUDA:
-        input_ = torch.ops.c10d_functional.all_reduce(input_, "sum", TAG,
-                                                      RANKSET, GROUP_SIZE)
+        # The functional collective is issued asynchronously and only waited
+        # on where the result is first used, so it can overlap with compute
+        # that does not depend on it (and inductor may reorder around it).
+        input_ = fc.all_reduce(input_, "sum", RANKSET, TAG)
     else:
         input_ = xm.all_reduce(xm.REDUCE_SUM, input_, groups=groups)
 
@@ -396,7 +398,9 @@ class ColumnParallelLinear(torch.nn.Module):
                 (self.output_size_per_partition, self.in_features),
                 dtype=torch.int8),
                                     requires_grad=False)
-            self.weight_scaler = Parameter(torch.zeros(1), requires_grad=False)
+            # One scale per output channel.
+            self.weight_scaler = Parameter(
+                torch.zeros(self.output_size_per_partition), requires_grad=False)
         else:
             self.weight = Parameter(
                 torch.Tensor(self.output_size_per_partition, self.in_features))
@@ -427,21 +431,55 @@ class ColumnParallelLinear(torch.nn.Module):
             self.weight.data.transpose(0, 1), self.groups, self.world_size,
             self.rank).transpose_(0, 1)
 
+    def _linear(self, input_parallel: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        """Local output features [start, end) of the layer."""
+        weight = self.weight[start:end]
+        bias = None if self.bias is None else self.bias[start:end]
+        if self.quant and self.gpu:
+            # GPUs do not support mixed int8 bf16 computation. Upcast the int8 weights inside the
+            # linear and apply the per-channel scales to the much smaller output; inductor fuses
+            # this into a weight-only int8 matmul that reads one byte per weight.
+            output_parallel = F.linear(input_parallel, weight.to(input_parallel.dtype))
+            output_parallel = output_parallel * self.weight_scaler[start:end]
+            if bias is not None:
+                output_parallel = output_parallel + bias
+        elif self.quant:
+            output_parallel = F.linear(input_parallel, weight, bias)
+            output_parallel = output_parallel * self.weight_scaler[start:end]
+        else:
+            output_parallel = F.linear(input_parallel, weight, bias)
+        return output_parallel
+
+    def argmax(self, input_: torch.Tensor, chunk_size: int = 4096) -> torch.Tensor:
+        """Index of the largest output feature, i.e. forward(input_).argmax(-1).
+
+        The output features are computed chunk_size at a time while keeping a
+        running maximum, so the full output is never materialized. Only the
+        unpartitioned layer is supported, and the weight must not be sharded
+        by SPMD either, or every chunk slice moves weight rows between devices.
+        """
+        assert self.world_size == 1
+        best_value, best_index = None, None
+        for start in range(0, self.output_size_per_partition, chunk_size):
+            end = min(start + chunk_size, self.output_size_per_partition)
+            value, index = self._linear(input_, start, end).max(dim=-1)
+            index = index + start
+            if best_value is None:
+                best_value, best_index = value, index
+            else:
+                # Strictly greater keeps the first index on ties, like argmax.
+                better = value > best_value
+                best_value = torch.where(better, value, best_value)
+                best_index = torch.where(better, index, best_index)
+        return best_index
+
     def forward(self, input_: torch.Tensor) -> torch.Tensor:  # type: ignore
         # Set up backprop all-reduce.
         input_parallel = copy_to_model_parallel_region(input_, self.groups,
                                                        self.world_size,
                                                        self.rank)
         # Matrix multiply.
-        if self.quant and self.gpu:
-            # GPUs do not support mixed int8 bf16 computation. Scale int8 weights to bf16 before linear.
-            scaled_weight = self.weight * self.weight_scaler
-            output_parallel = F.linear(input_parallel, scaled_weight, self.bias)
-        elif self.quant:
-            output_parallel = F.linear(input_parallel, self.weight, self.bias)
-            output_parallel = output_parallel * self.weight_scaler
-        else:
-            output_parallel = F.linear(input_parallel, self.weight, self.bias)
+        output_parallel = self._linear(input_parallel, 0, self.output_size_per_partition)
         if self.gather_output:
             # All-gather across the partitions.
             output = gather_from_model_parallel_region(output_parallel,
@@ -525,7 +563,9 @@ class RowParallelLinear(torch.nn.Module):
                 (self.out_features, self.input_size_per_partition),
                 dtype=torch.int8),
                                     requires_grad=False)
-            self.weight_scaler = Parameter(torch.zeros(1), requires_grad=False)
+            # One scale per output channel.
+            self.weight_scaler = Parameter(
+                torch.zeros(self.out_features), requires_grad=False)
         else:
             self.weight = Parameter(
                 torch.Tensor(self.out_features, self.input_size_per_partition))
@@ -564,9 +604,12 @@ class RowParallelLinear(torch.nn.Module):
                 input_, self.groups, self.world_size, self.rank)
         # Matrix multiply.
         if self.quant and self.gpu:
-            # GPUs do not support mixed int8 bf16 computation. Scale int8 weights to bf16 before linear.
-            scaled_weight = self.weight * self.weight_scaler
-            output_parallel = F.linear(input_parallel, scaled_weight, self.bias)
+            # GPUs do not support mixed int8 bf16 computation. Upcast the int8 weights inside the
+            # linear and apply the per-channel scales to the much smaller output; inductor fuses
+            # this into a weight-only int8 matmul that reads one byte per weight.
+            # The bias is added once after the all-reduce below.
+            output_parallel = F.linear(input_parallel, self.weight.to(input_parallel.dtype))
+            output_parallel = output_parallel * self.weight_scaler
         elif self.quant:
             output_parallel = F.linear(input_parallel, self.weight, self.bias)
             output_parallel = output_parallel * self.weight_scaler
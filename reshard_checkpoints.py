@@ -9,6 +9,7 @@ from pathlib import Path
 from fairscale.nn.model_parallel.utils import divide_and_check_no_remainder, split_tensor_along_last_dim
 
 from llama import ModelArgs, Transformer, Tokenizer
+from llama.model import fuse_checkpoint
 from llama.xla_model_parallel import (
     ParallelEmbedding,
     RowParallelLinear,
@@ -48,16 +49,22 @@ def reshard(original_mp, target_mp, ckpt_dir, output_dir, tokenizer_path):
 
     state_dict_key_filter = set([
         "tok_embeddings",
-        "attention.wq",
-        "attention.wk",
-        "attention.wv",
+        "attention.wqkv",
         "attention.wo",
-        "feed_forward.w1",
+        "feed_forward.w13",
         "feed_forward.w2",
-        "feed_forward.w3",
         "output",
     ])
 
+    def shard_rows(weight, num_shards, rank):
+        return split_tensor_along_last_dim(weight.transpose(0, 1),
+                                           num_shards)[rank].transpose(0, 1)
+
+    if kv_head_duplicate is None:
+        kv_factor = factor
+    else:
+        kv_factor = factor // kv_head_duplicate
+
     original_rank = -1
     reload_model = False
     for target_rank in range(target_mp):
@@ -67,7 +74,7 @@ def reshard(original_mp, target_mp, ckpt_dir, output_dir, tokenizer_path):
 
         if reload_model:
             ckpt_path = checkpoints[original_rank]
-            checkpoint = torch.load(ckpt_path, map_location="cpu")
+            checkpoint = fuse_checkpoint(torch.load(ckpt_path, map_location="cpu"))
 
             model_args: ModelArgs = ModelArgs(**params)
             tokenizer = Tokenizer(model_path=tokenizer_path)
@@ -112,14 +119,28 @@ def reshard(original_mp, target_mp, ckpt_dir, output_dir, tokenizer_path):
             elif isinstance(module, ColumnParallelLinear):
                 source_module = original_model.get_submodule(name)
                 assert module.bias is None and source_module.bias is None
-                if (".wk" not in name and ".wv" not in name) or (kv_head_duplicate is None):
-                    weight_shard = split_tensor_along_last_dim(
-                        source_module.weight.data.transpose(0, 1),
-                        factor)[shard_rank].transpose(0, 1).contiguous()
+                kv_rank = shard_rank if kv_head_duplicate is None else shard_rank // kv_head_duplicate
+                if name.endswith(".wqkv"):
+                    # Shard q, k and v separately so every target rank keeps
+                    # its own heads of each projection.
+                    source_attention = original_model.get_submodule(name[:-len(".wqkv")])
+                    q_size = source_attention.n_local_heads * source_attention.head_dim
+                    kv_size = source_attention.n_local_kv_heads * source_attention.head_dim
+                    wq, wk, wv = source_module.weight.data.split([q_size, kv_size, kv_size])
+                    weight_shard = torch.cat([
+                        shard_rows(wq, factor, shard_rank),
+                        shard_rows(wk, kv_factor, kv_rank),
+                        shard_rows(wv, kv_factor, kv_rank),
+                    ]).contiguous()
+                elif name.endswith(".w13"):
+                    w1, w3 = source_module.weight.data.chunk(2)
+                    weight_shard = torch.cat([
+                        shard_rows(w1, factor, shard_rank),
+                        shard_rows(w3, factor, shard_rank),
+                    ]).contiguous()
                 else:
-                    weight_shard = split_tensor_along_last_dim(
-                        source_module.weight.data.transpose(0, 1),
-                        factor // kv_head_duplicate)[shard_rank // kv_head_duplicate].transpose(0, 1).contiguous()
+                    weight_shard = shard_rows(source_module.weight.data, factor,
+                                              shard_rank).contiguous()
                 assert weight_shard.size() == module.weight.size()
                 module.weight.copy_(weight_shard)
 